@@ -97,7 +97,7 @@ class BotService:
                 flood_info = ""
                 if self.forwarder:
                     flood_clients = [c.session_name_for_forwarder for c in current_clients 
-                                     if self.forwarder.client_flood_wait.get(c.session_name_for_forwarder, 0) > time.time()]
+                                     if self.forwarder.client_flood_wait.get(c.session_name_for_forwarder, 0) > time.monotonic()]
                     if flood_clients:
                         flood_info = f" ({len(flood_clients)} 个 FloodWait)"
                 
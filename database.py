@@ -4,7 +4,7 @@ import aiosqlite
 import asyncio
 import json
 from datetime import datetime, timedelta
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Set, Union
 
 from loguru import logger
 
@@ -32,6 +32,8 @@ async def init_db():
             _db_conn = await aiosqlite.connect(DB_PATH)
             # 启用 WAL 模式提高并发性能
             await _db_conn.execute("PRAGMA journal_mode=WAL;")
+            # WAL 下 NORMAL 只在检查点时 fsync，掉电最多丢失最近的事务，不会损坏数据库
+            await _db_conn.execute("PRAGMA synchronous=NORMAL;")
             
             logger.info(f"✅ 数据库连接已建立: {DB_PATH}")
 
@@ -247,6 +249,18 @@ async def add_hash(hash_str: str):
         await db.commit()
     except Exception: pass
 
+async def check_hashes(hashes: List[str]) -> Set[str]:
+    """批量查询，返回其中已存在的哈希 (异常时与 check_hash 一致，视为全部已存在)"""
+    if not hashes: return set()
+    try:
+        db = await get_db()
+        placeholders = ",".join("?" * len(hashes))
+        async with db.execute(f"SELECT hash FROM dedup_hashes WHERE hash IN ({placeholders})", hashes) as cursor:
+            return {row[0] for row in await cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"批量查询去重哈希失败，本批按重复处理: {e}")
+        return set(hashes)
+
 async def prune_old_hashes(days: int = 30):
     try:
         cutoff = datetime.now() - timedelta(days=days)
@@ -270,6 +284,23 @@ async def set_progress(channel_id: int, message_id: int):
         await db.commit()
     except Exception: pass
 
+async def write_batch(hashes: List[str], progress: Dict[int, int]):
+    """在同一个事务中批量写入去重哈希与频道进度，只提交一次；失败时抛出异常"""
+    if not hashes and not progress: return
+    db = await get_db()
+    try:
+        if hashes:
+            now = datetime.now()
+            await db.executemany("INSERT OR REPLACE INTO dedup_hashes (hash, timestamp) VALUES (?, ?)", [(h, now) for h in hashes])
+        if progress:
+            await db.executemany("INSERT OR REPLACE INTO forward_progress (channel_id, message_id) VALUES (?, ?)", list(progress.items()))
+        await db.commit()
+    except Exception:
+        # 回滚未提交的部分并交给调用方处理，调用方会保留数据在下次重试
+        try: await db.rollback()
+        except Exception: pass
+        raise
+
 async def get_db_stats() -> dict:
     try:
         db = await get_db()
@@ -299,6 +330,15 @@ async def add_pending_link(url: str, mid: int):
         await db.commit()
     except: pass
 
+async def add_pending_links(rows: List[tuple]):
+    """批量登记待检测链接，rows 为 (url, message_id)，单个事务提交"""
+    if not rows: return
+    try:
+        db = await get_db()
+        await db.executemany("INSERT OR IGNORE INTO link_checker (url, message_id, status) VALUES (?, ?, 'pending')", rows)
+        await db.commit()
+    except: pass
+
 async def get_links_to_check() -> list:
     try:
         db = await get_db()
@@ -310,4 +350,14 @@ async def update_link_status(url: str, status: str):
         db = await get_db()
         await db.execute("UPDATE link_checker SET status = ?, last_checked = ? WHERE url = ?", (status, datetime.now(), url))
         await db.commit()
+    except: pass
+
+async def update_link_statuses(rows: List[tuple]):
+    """批量更新检测结果，rows 为 (url, status)，单个事务提交"""
+    if not rows: return
+    try:
+        db = await get_db()
+        now = datetime.now()
+        await db.executemany("UPDATE link_checker SET status = ?, last_checked = ? WHERE url = ?", [(status, now, url) for url, status in rows])
+        await db.commit()
     except: pass
\ No newline at end of file
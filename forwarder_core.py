@@ -3,51 +3,211 @@ import logging
 import random
 import re
 import asyncio
+import functools
 import httpx
 import time
 import json
 import os 
+from collections import OrderedDict
 from datetime import datetime, timezone
 from telethon import TelegramClient, events, errors
-from telethon.tl.types import Message, MessageEntityTextUrl, MessageMediaDocument, PeerUser, PeerChat, PeerChannel
+from telethon.tl.types import Message, MessageEntityTextUrl, MessageMediaDocument, MessageMediaPhoto, PeerUser, PeerChat, PeerChannel
+from telethon.tl.types import DocumentAttributeFilename
 from telethon.tl.types import Channel, Chat
 from telethon.tl.types import MessageMediaWebPage
 
 import database
-import web_server
 
-from typing import List, Optional, Tuple, Dict, Set, Any, Union 
-from models import Config, SourceConfig
+from typing import List, Optional, Tuple, Dict, Set, Any, Union, Callable, Awaitable 
+from models import Config, SourceConfig, RulesDatabase, CompiledRule
+from keyword_matcher import KeywordMatcher
 
 from loguru import logger
 
+# 去重摘要固定使用 xxh3_128 (SIMD，跨进程稳定)；不设回退算法，否则装卸 xxhash 会让已存的去重键全部失配
+import xxhash
+
+# RE2 (线性时间，无灾难性回溯) 可选，仅在已安装且全部模式都受支持时用于合并后的广告正则
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# Telethon 检测到 cryptg 时会自动用 C 实现 (AES-NI) 处理 MTProto 的 AES-IGE 加解密
+try:
+    import cryptg  # noqa: F401
+except ImportError:
+    cryptg = None
+
+# 含数字反向引用 (\1 等) 的正则合并进交替式后分组编号会错位，需单独匹配
+_NUMBERED_BACKREF = re.compile(r'\\[1-9]')
+
+# RE2 中 \d \w \s \b 及其取反形式只匹配 ASCII，对全角数字、中文等的结果与 re 不同；
+# 含这些转义 (前面的反斜杠不是被转义的) 的模式只能用 re 引擎
+_RE2_ASCII_ESCAPE = re.compile(r'(?<!\\)(?:\\\\)*\\[dDwWsSbB]')
+
+# 同一文本在查重和标记已处理时各计算一次摘要，相册说明文字也会重复出现，缓存最近的结果
+@functools.lru_cache(maxsize=4096)
+def _text_digest(text: str) -> str:
+    return xxhash.xxh3_128_hexdigest(text.encode('utf-8', 'ignore'))
+
+# 发送队列：Telegram 对单个聊天约 1 条/秒，全局约 30 条/秒
+_TARGET_MIN_INTERVAL = 1.05
+_MAX_CONCURRENT_SENDS = 25
+_SEND_QUEUE_SIZE = 200
+
+# 发送时可重试的临时性错误
+_TRANSIENT_SEND_ERRORS = (errors.ServerError, errors.TimedOutError, errors.RpcCallFailError, ConnectionError, asyncio.TimeoutError)
+_SEND_RETRIES = 3
+
+# 去重哈希与频道进度的批量落盘间隔 (秒)
+_FLUSH_INTERVAL = 0.5
+
+try:
+    from re import _parser as _sre_parser
+except ImportError: # Python < 3.11
+    import sre_parse as _sre_parser
+
+def _required_literal(pattern: str) -> str:
+    """
+    提取正则在任何匹配中都必须出现的最长字面量 (小写)，用于在运行正则前做子串预筛。
+    只看顶层连续的字面量字符；顶层含分支或无法解析时返回空串，表示无法预筛。
+    """
+    try:
+        items = _sre_parser.parse(pattern)
+    except Exception:
+        return ""
+    best, run = "", []
+    for op, av in items:
+        if op == _sre_parser.LITERAL:
+            run.append(chr(av))
+            continue
+        if len(run) > len(best): best = "".join(run)
+        run = []
+    if len(run) > len(best): best = "".join(run)
+    return best.lower()
+
+# 频道/超级群的 "-100" 前缀 ID 等于 -(10^12 + 原始 ID)，用整数运算代替字符串拼接
+_CHANNEL_ID_OFFSET = 10 ** 12
+
+# 全词关键词的分词方式：纯单词字符组成的关键词被 \b 包围时，等价于文本中一个完整的 \w+ 词元
+_WORD_RE = re.compile(r'\w+')
+
+# --- 限速 ---
+
+class TokenBucket:
+    """异步令牌桶：在发送前主动整形速率，而不是等 FloodWait 之后再被动退避"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.last = time.monotonic()
+
+    async def acquire(self):
+        if self.rate <= 0: return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# --- 熔断 ---
+
+class CircuitBreaker:
+    """
+    (客户端, 目标) 熔断器。
+    CLOSED: 正常放行；连续 3 次永久性写入错误后进入 OPEN，300 秒内直接跳过；
+    冷却结束进入 HALF_OPEN，仅放行一次探测，成功则关闭，失败则重新打开。
+    """
+    THRESHOLD = 3
+    COOLDOWN = 300.0
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_at: Optional[float] = None
+
+    def is_open(self) -> bool:
+        if self.opened_at is None: return False
+        now = time.monotonic()
+        if now - self.opened_at < self.COOLDOWN: return True
+        # HALF_OPEN：已有探测在途时拒绝其余请求 (探测结果迟迟未回报时按冷却时间放弃)
+        return self.probe_at is not None and now - self.probe_at < self.COOLDOWN
+
+    def on_pick(self):
+        if self.opened_at is not None:
+            self.probe_at = time.monotonic()
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probe_at is not None or self.failures >= self.THRESHOLD:
+            self.opened_at = time.monotonic()
+            self.failures = 0
+            self.probe_at = None
+
 # --- 核心转发器类 ---
 
 class UltimateForwarder:
     docker_container_name: str = "tg-forwarder"
 
-    def __init__(self, config: Config, clients: List[TelegramClient]):
+    def __init__(self, config: Config, clients: List[TelegramClient], rules_db: RulesDatabase):
         self.config = config
         self.clients = clients
+        self.rules_db = rules_db
         self.current_client_index = 0
-        self.client_flood_wait: Dict[str, float] = {} 
+        self.client_flood_wait: Dict[str, float] = {} # time.monotonic() 截止时间
+        self.client_buckets: Dict[str, TokenBucket] = self._build_buckets()
+        if cryptg is None:
+            logger.warning("未安装 cryptg，Telethon 将使用纯 Python 实现的 AES 加解密，收发大量消息/媒体时 CPU 占用会明显升高。")
         
-        # 初始化正则
-        ad_filter = web_server.rules_db.ad_filter
-        self.ad_patterns = self._compile_patterns(ad_filter.patterns if ad_filter and ad_filter.patterns else [])
-        self.ad_keyword_word_patterns = self._compile_word_patterns(ad_filter.keywords_word if ad_filter and ad_filter.keywords_word else [])
+        # 最近转发过的去重哈希 (LRU)，命中时无需访问数据库
+        self._hash_cache: "OrderedDict[str, None]" = OrderedDict()
+        self._hash_cache_max = 50000
+        
+        # 分发决策缓存：键为规则实际读取的全部输入 (文本、MIME、文件名)，规则或目标变化时清空
+        self._target_cache: "OrderedDict[Tuple[str, Optional[str], Optional[str]], Tuple[Optional[int], Optional[int]]]" = OrderedDict()
+        self._target_cache_max = 4096
+        
+        # 已解析的目标标识 -> 规范化 ID，热重载时跳过已知目标的网络请求
+        self._entity_cache: Dict[str, int] = {}
+        
+        # 去重哈希与频道进度先在内存中累积，由后台协程每 0.5 秒在一个事务内批量落盘
+        self._pending_hashes: List[str] = []
+        self._progress_dirty: Dict[int, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        
+        # 目标 -> 发送队列 / 发送协程；在途哈希用于排队期间的去重
+        self._send_queues: Dict[int, asyncio.Queue] = {}
+        self._send_workers: Dict[int, asyncio.Task] = {}
+        self._send_semaphore = asyncio.Semaphore(_MAX_CONCURRENT_SENDS)
+        self._inflight_hashes: Set[str] = set()
+        
+        # (客户端, 目标) -> 熔断器，避免对无权限的目标反复尝试
+        self._breakers: Dict[Tuple[str, int], CircuitBreaker] = {}
+        
+        # 初始化正则与预处理后的关键词
+        self.refresh_rules()
         
         # 打印初始配置
-        settings = web_server.rules_db.settings
+        settings = self.rules_db.settings
         logger.info(f"终极转发器核心已初始化。")
         logger.info(f"转发模式: {settings.forwarding_mode}")
     
-    async def reload(self, new_config: Config):
+    async def reload(self, new_config: Config, rules_db: Optional[RulesDatabase] = None):
         self.config = new_config
+        if rules_db is not None: self.rules_db = rules_db
+        self.client_buckets = self._build_buckets()
         
-        new_ad_filter = web_server.rules_db.ad_filter
-        self.ad_patterns = self._compile_patterns(new_ad_filter.patterns if new_ad_filter and new_ad_filter.patterns else [])
-        self.ad_keyword_word_patterns = self._compile_word_patterns(new_ad_filter.keywords_word if new_ad_filter and new_ad_filter.keywords_word else [])
+        self.refresh_rules()
         
         await self.resolve_targets() 
         
@@ -61,20 +221,16 @@ class UltimateForwarder:
         if not self.clients: return
         client = self.clients[0]
         
-        # (新增) 用于更新源标题的辅助函数
-        async def update_source_title(identifier, title, resolved_id):
-            for s in web_server.rules_db.sources:
-                if str(s.identifier) == str(identifier):
-                    s.cached_title = title
-                    s.resolved_id = resolved_id
-                    # 顺便保存到文件，避免下次启动丢失
-                    await web_server.save_rules_to_db()
-                    break
-
-        async def normalize_target(identifier: Union[str, int], is_source: bool = False) -> Optional[int]:
+        # 源的解析与标题缓存由 ultimate_forwarder.resolve_identifiers 负责，这里只解析目标
+        async def normalize_target(identifier: Union[str, int]) -> Optional[int]:
             try:
                 if not identifier: return None
                 
+                cache_key = str(identifier).strip()
+                if cache_key in self._entity_cache:
+                    logger.debug("目标 '{}' 命中解析缓存 (ID: {})", identifier, self._entity_cache[cache_key])
+                    return self._entity_cache[cache_key]
+                
                 # [Fix] 强制类型转换：将数字字符串转为 int
                 # Telethon 对 "-100xxx" 字符串支持不佳，必须转为 int
                 search_key = identifier
@@ -87,11 +243,11 @@ class UltimateForwarder:
                 entity = None
                 try:
                     entity = await client.get_entity(search_key)
-                except (ValueError, errors.RpcError) as e:
+                except (ValueError, errors.RPCError) as e:
                     # [Fix] 尝试策略 2: 如果是 -100 开头的 ID 失败，尝试去掉前缀
-                    if isinstance(search_key, int) and str(search_key).startswith("-100"):
+                    if isinstance(search_key, int) and search_key < -_CHANNEL_ID_OFFSET:
                         try:
-                            stripped_id = int(str(search_key)[4:])
+                            stripped_id = -search_key - _CHANNEL_ID_OFFSET
                             logger.debug(f"尝试使用无前缀 ID 查找: {stripped_id}")
                             entity = await client.get_entity(stripped_id)
                         except:
@@ -121,17 +277,14 @@ class UltimateForwarder:
                 if not title and hasattr(entity, 'username'):
                     title = entity.username
                 
-                # 规范化 ID (确保是 -100 开头)
-                if isinstance(entity, Channel) and not str(resolved_id).startswith("-100"):
-                    resolved_id = int(f"-100{resolved_id}")
-                elif isinstance(entity, Chat) and not str(resolved_id).startswith("-"):
-                    resolved_id = int(f"-{resolved_id}")
+                # 规范化 ID (频道为 -100 前缀，即 -(10^12 + id)；普通群为负数)
+                if isinstance(entity, Channel) and resolved_id > 0:
+                    resolved_id = -(_CHANNEL_ID_OFFSET + resolved_id)
+                elif isinstance(entity, Chat) and resolved_id > 0:
+                    resolved_id = -resolved_id
                 
-                # 如果是源，更新标题缓存
-                if is_source and title:
-                     await update_source_title(identifier, title, resolved_id)
-
                 logger.info(f"目标 '{identifier}' -> {title} (ID: {resolved_id})")
+                self._entity_cache[cache_key] = resolved_id
                 return resolved_id
             except Exception as e:
                 logger.error(f"❌ 无法解析目标: {identifier} - {e}")
@@ -140,47 +293,181 @@ class UltimateForwarder:
                     logger.warning("⚠️ 触发了 Telegram API 限制 (FloodWait)。建议暂停操作几分钟。")
                 return None
         
-        # 解析默认目标
-        settings = web_server.rules_db.settings
-        if settings.default_target:
-            self.config.targets.resolved_default_target_id = await normalize_target(settings.default_target)
+        # 收集默认目标和分发规则目标，去重后并发解析 (一次往返而不是逐个等待)
+        settings = self.rules_db.settings
+        rules = self.rules_db.distribution_rules
+        identifiers = [settings.default_target] if settings.default_target else []
+        identifiers.extend(rule.target_identifier for rule in rules)
+        unique_ids = list(dict.fromkeys(identifiers))
+        # 限制同时在途的解析请求数，规则很多时避免瞬间打满 API 触发 FloodWait
+        sem = asyncio.Semaphore(4)
+        async def guarded(identifier):
+            async with sem:
+                return await normalize_target(identifier)
+        resolved = dict(zip(unique_ids, await asyncio.gather(*(guarded(i) for i in unique_ids))))
         
-        # 解析分发规则目标
-        for rule in web_server.rules_db.distribution_rules:
-            rule.resolved_target_id = await normalize_target(rule.target_identifier)
+        if settings.default_target:
+            self.config.targets.resolved_default_target_id = resolved[settings.default_target]
+        for rule in rules:
+            rule.resolved_target_id = resolved[rule.target_identifier]
+
+        self._target_cache.clear()
 
         # [Optimization] 已移除：不再重复解析源
         # UltimateForwarder.resolve_identifiers 已经完成了这项工作
         # 此处的重复循环是导致热重载缓慢的主要原因
 
+    def refresh_rules(self):
+        """
+        根据当前规则库预计算过滤所需的数据 (编译正则、小写关键词)。
+        规则在两次重载之间是静态的，无需在每条消息上重复计算。
+        Web 面板修改规则后也会回调此方法。
+        """
+        rules_db = self.rules_db
+        ad_filter = rules_db.ad_filter
+        whitelist = rules_db.whitelist
+        content_filter = rules_db.content_filter
+
+        self.ad_patterns = self._compile_patterns(ad_filter.patterns if ad_filter and ad_filter.patterns else [])
+        word_keywords = [kw.lower() for kw in (ad_filter.keywords_word or [])] if ad_filter else []
+        # 纯单词关键词走词元集合查找，含标点/空格等的关键词才需要正则
+        self._ad_word_set: frozenset = frozenset(kw for kw in word_keywords if _WORD_RE.fullmatch(kw))
+        self._ad_word_union = self._compile_word_union([kw for kw in word_keywords if kw and kw not in self._ad_word_set])
+        self._ad_union, self._ad_union_sources, self._ad_residual = self._compile_union(self.ad_patterns)
+        
+        # 正则预筛：每个模式都有必需字面量时，文本中一个字面量都不出现就不必运行合并正则
+        # (全词关键词本身就是字面量)；残余模式逐个预筛
+        union_literals = [_required_literal(src) for src in self._ad_union_sources]
+        self._ad_union_prefilter = KeywordMatcher(union_literals) if union_literals and all(union_literals) else None
+        self._ad_word_prefilter = KeywordMatcher(kw for kw in word_keywords if kw not in self._ad_word_set) if self._ad_word_union else None
+        self._ad_residual_literals = [_required_literal(p.pattern) for p in self._ad_residual]
+
+        self._whitelist_matcher = KeywordMatcher((whitelist.keywords or []) if whitelist else [])
+        self._ad_sub_matcher = KeywordMatcher((ad_filter.keywords_substring or []) if ad_filter else [])
+        self._ad_file_matcher = KeywordMatcher((ad_filter.file_name_keywords or []) if ad_filter else [])
+        self._meaningless_set: frozenset = frozenset(w.lower() for w in content_filter.meaningless_words) if content_filter else frozenset()
+
+        # 热路径读取的开关和参数在此快照，每条消息不再逐级访问规则库对象
+        self._whitelist_enabled = bool(whitelist and whitelist.enable)
+        self._ad_filter_enabled = bool(ad_filter and ad_filter.enable)
+        self._content_filter_enabled = bool(content_filter and content_filter.enable)
+        self._min_meaningful_length = content_filter.min_meaningful_length if content_filter else 0
+        self._default_topic_id = rules_db.settings.default_topic_id
+
+        # 发送方式按转发模式预先选定，发送路径上不再比较字符串
+        settings = rules_db.settings
+        self._prepare_send = self._prepare_copy if settings.forwarding_mode == 'copy' else self._prepare_forward
+        self._mark_target_read_enabled = bool(settings.mark_target_as_read)
+
+        # 所有分发规则的关键词合并为一个自动机，每条消息只扫描一次，各规则按命中集合判断
+        self._rule_kw_matcher = KeywordMatcher(kw for rule in rules_db.distribution_rules for kw in rule.keywords)
+        compiled_rules = [rule.compiled for rule in rules_db.distribution_rules]
+        # 按消息是否有文本 / 文档分桶 (保持规则优先级顺序)，跳过必然不会命中的规则：
+        # 需要文本 = 有 AND 关键词，或 OR 条件只有关键词；需要文档 = OR 条件里没有关键词
+        def needs_text(r: CompiledRule) -> bool:
+            return bool(r.all_required) or (r.has_or and not (r.file_types_lower or r.name_substrings or r.name_regex))
+        def needs_doc(r: CompiledRule) -> bool:
+            return r.has_or and not r.any_set
+        self._rule_buckets: Dict[Tuple[bool, bool], Tuple[CompiledRule, ...]] = {
+            (has_text, has_doc): tuple(r for r in compiled_rules if (has_text or not needs_text(r)) and (has_doc or not needs_doc(r)))
+            for has_text in (True, False) for has_doc in (True, False)
+        }
+
+        # 替换规则合并为一个交替式，最长的键优先，单次扫描完成全部替换
+        self._repl_map: Dict[str, str] = {k: v for k, v in (rules_db.replacements or {}).items() if k}
+        self._repl_re: Optional[re.Pattern] = re.compile(
+            '|'.join(re.escape(k) for k in sorted(self._repl_map, key=len, reverse=True))
+        ) if self._repl_map else None
+        # 所有键都是单个字符时改用 str.translate，整张映射表在 C 层一次完成
+        self._repl_table: Optional[Dict[int, str]] = str.maketrans(self._repl_map) if self._repl_map and all(len(k) == 1 for k in self._repl_map) else None
+
+        # 源 ID -> 源配置，每条消息 O(1) 查找
+        self._source_by_id: Dict[int, SourceConfig] = {s.resolved_id: s for s in rules_db.sources if s.resolved_id}
+
+        self._target_cache.clear()
+
+    def _build_buckets(self) -> Dict[str, TokenBucket]:
+        forwarding = self.config.forwarding
+        return {
+            c.session_name_for_forwarder: TokenBucket(forwarding.send_rate, forwarding.send_burst)
+            for c in self.clients
+        }
+
     async def _get_channel_progress(self, channel_id: int) -> int:
+        if channel_id in self._progress_dirty:
+            return self._progress_dirty[channel_id]
         return await database.get_progress(channel_id)
 
     async def _set_channel_progress(self, channel_id: int, message_id: int):
-        await database.set_progress(channel_id, message_id)
+        self._progress_dirty[channel_id] = max(self._progress_dirty.get(channel_id, 0), message_id)
+        self._ensure_flush_worker()
 
-    def _get_next_client(self) -> TelegramClient:
-        start_index = self.current_client_index
+    def _ensure_flush_worker(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_worker())
+
+    async def _flush_worker(self):
+        """后台定时落盘，写入失败的数据留在内存中由下一轮重试；进程异常退出时最多丢失 0.5 秒内的哈希与进度"""
         while True:
-            client = self.clients[self.current_client_index]
-            client_key = client.session_name_for_forwarder
-            wait_until = self.client_flood_wait.get(client_key, 0)
-            
-            if time.time() > wait_until:
-                self.current_client_index = (self.current_client_index + 1) % len(self.clients)
+            await asyncio.sleep(_FLUSH_INTERVAL)
+            try:
+                await self.flush_progress()
+            except Exception as e:
+                logger.error(f"批量落盘失败: {e}")
+
+    async def flush_progress(self):
+        """把内存中累积的去重哈希与频道进度写入数据库 (关闭前也需调用一次)"""
+        if not self._pending_hashes and not self._progress_dirty: return
+        hashes, self._pending_hashes = self._pending_hashes, []
+        # 进度在写完之前仍保留在内存中，_get_channel_progress 不会读到旧值
+        progress = dict(self._progress_dirty)
+        try:
+            await database.write_batch(hashes, progress)
+        except BaseException:
+            # 写入失败 (数据库繁忙、磁盘满等) 或被取消时把哈希放回队首，进度保持不变，下一轮重试
+            self._pending_hashes[:0] = hashes
+            raise
+        for cid, mid in progress.items():
+            if self._progress_dirty.get(cid) == mid:
+                del self._progress_dirty[cid]
+
+    async def _get_next_client(self, target_id: Optional[int] = None) -> Optional[TelegramClient]:
+        """轮询选择客户端，跳过处于 FloodWait 或对该目标已熔断的客户端；全部熔断时返回 None"""
+        while True:
+            n = len(self.clients)
+            waiting_until: List[float] = []
+            for _ in range(n):
+                client = self.clients[self.current_client_index]
+                self.current_client_index = (self.current_client_index + 1) % n
+                client_key = client.session_name_for_forwarder
+                breaker = self._breakers.get((client_key, target_id)) if target_id is not None else None
+                if breaker and breaker.is_open():
+                    continue
+                wait_until = self.client_flood_wait.get(client_key, 0)
+                if time.monotonic() <= wait_until:
+                    waiting_until.append(wait_until)
+                    continue
+                if breaker: breaker.on_pick()
                 return client
             
-            self.current_client_index = (self.current_client_index + 1) % len(self.clients)
-            if self.current_client_index == start_index:
-                time.sleep(5) 
-                continue
+            if not waiting_until:
+                return None
+            # 可用客户端均处于 FloodWait：挂起到最早解除的那一个，期间不阻塞事件循环
+            await asyncio.sleep(max(1.0, min(waiting_until) - time.monotonic() + 1.0))
 
-    async def _handle_send_error(self, e: Exception, client: TelegramClient):
+    async def _handle_send_error(self, e: Exception, client: TelegramClient, target_id: Optional[int] = None):
         client_key = client.session_name_for_forwarder
         if isinstance(e, errors.FloodWaitError):
             wait_time = e.seconds + 5 
             logger.warning(f"客户端 {client_key} 触发 FloodWait: {wait_time} 秒。")
-            self.client_flood_wait[client_key] = time.time() + wait_time
+            self.client_flood_wait[client_key] = time.monotonic() + wait_time
+        elif isinstance(e, (errors.ChatWriteForbiddenError, errors.UserBannedInChannelError)) and target_id is not None:
+            breaker = self._breakers.setdefault((client_key, target_id), CircuitBreaker())
+            breaker.record_failure()
+            if breaker.opened_at is not None and breaker.failures == 0:
+                logger.warning(f"客户端 {client_key} 无法写入目标 {target_id} ({type(e).__name__})，暂停使用该组合 {int(CircuitBreaker.COOLDOWN)} 秒。")
+            else:
+                logger.error(f"客户端 {client_key} 错误: {e}")
         else:
             logger.error(f"客户端 {client_key} 错误: {e}")
 
@@ -197,35 +484,36 @@ class UltimateForwarder:
             except Exception:
                  return
         
-        if numeric_chat_id > 1000000000 and not str(numeric_chat_id).startswith("-100"):
-            numeric_chat_id = int(f"-100{numeric_chat_id}")
-        
-        source_config = None
-        for s in web_server.rules_db.sources:
-            if s.resolved_id == numeric_chat_id:
-                source_config = s
-                break
+        if numeric_chat_id > 1000000000:
+            numeric_chat_id = -(_CHANNEL_ID_OFFSET + numeric_chat_id)
         
+        source_config = self._source_by_id.get(numeric_chat_id)
         if not source_config: return
 
         try:
+            text = message.text or ""
+            mime_type, file_name = self._document_info(message.media)
             msg_data = {
-                "text": message.text or "",
+                "text": text,
+                "text_lower": text.lower(), # 只计算一次，过滤与分发共用
                 "media": message.media,
-                "hash_source": message.id
+                "mime_type": mime_type,
+                "file_name": file_name,
+                "hash_source": message.id,
+                "group": all_messages_in_group
             }
 
             # 过滤检查 (返回原因和关键词)
-            filter_reason, filter_keyword = self._should_filter(msg_data['text'], msg_data['media'])
+            filter_reason, filter_keyword = self._should_filter(msg_data['text'], msg_data['text_lower'], msg_data['media'], msg_data['file_name'])
             if filter_reason:
-                logger.info(f"消息 {message.id} 被过滤。原因: {filter_reason} | 关键词: {filter_keyword}")
+                logger.info("消息 {} 被过滤。原因: {} | 关键词: {}", message.id, filter_reason, filter_keyword)
                 return 
 
             if await self._is_duplicate(msg_data, f"{numeric_chat_id}/{message.id}"):
-                logger.info(f"消息 {message.id} 重复。")
+                logger.info("消息 {} 重复。", message.id)
                 return 
 
-            target_id, topic_id = self._find_target(msg_data['text'], msg_data['media'])
+            target_id, topic_id = self._find_target(msg_data['text'], msg_data['text_lower'], msg_data['mime_type'], msg_data['file_name'])
             
             if not target_id:
                 logger.error(f"消息 {message.id} 无有效目标。")
@@ -234,22 +522,66 @@ class UltimateForwarder:
             msg_data['text'] = self._apply_replacements(msg_data['text']) 
             messages_to_send = all_messages_in_group if all_messages_in_group else message
 
-            await self._send_message(
-                original_message=messages_to_send, 
-                message_data=msg_data,
-                target_id=target_id,
-                topic_id=topic_id
-            )
-            
-            await self._mark_as_processed(msg_data)
+            # 发送交给目标的发送队列异步完成，接收侧不被下游限速拖慢
+            await self._enqueue_send(messages_to_send, msg_data, target_id, topic_id)
             
         except Exception as e:
             logger.error(f"处理消息失败: {e}", exc_info=True)
         finally:
-            await self._set_channel_progress(numeric_chat_id, message.id)
+            # 相册整组只记录一次进度，取组内最大的消息 ID
+            last_id = max(m.id for m in all_messages_in_group) if all_messages_in_group else message.id
+            await self._set_channel_progress(numeric_chat_id, last_id)
+
+    # --- 发送队列 ---
+
+    async def _enqueue_send(self, original_message: Union[Message, List[Message]], message_data: Dict[str, Any], target_id: int, topic_id: Optional[int]):
+        # 排队期间哈希记为在途，避免同一内容在真正发出前被再次入队
+        self._inflight_hashes.update(self._get_message_hashes(message_data))
+        queue = self._send_queues.get(target_id)
+        if queue is None:
+            queue = self._send_queues[target_id] = asyncio.Queue(maxsize=_SEND_QUEUE_SIZE)
+            self._send_workers[target_id] = asyncio.create_task(self._send_worker(target_id, queue))
+        await queue.put((original_message, message_data, target_id, topic_id))
+
+    async def _send_worker(self, target_id: int, queue: asyncio.Queue):
+        """每个目标一个发送协程：按单聊天限速逐条发送，全局并发由信号量限制"""
+        pacer = TokenBucket(1 / _TARGET_MIN_INTERVAL, 1)
+        while True:
+            original_message, message_data, target_id, topic_id = await queue.get()
+            try:
+                await pacer.acquire()
+                async with self._send_semaphore:
+                    sent = await self._send_message(original_message, message_data, target_id, topic_id)
+                # 只有真正发出的消息才记入去重，熔断跳过或发送失败的消息之后仍可再次转发
+                if sent:
+                    await self._mark_as_processed(message_data)
+            except Exception as e:
+                logger.error(f"发送到 {target_id} 失败: {e}", exc_info=True)
+            finally:
+                self._inflight_hashes.difference_update(self._get_message_hashes(message_data))
+                queue.task_done()
+
+    async def shutdown(self, timeout: float = 10.0):
+        """关闭前尽量发完队列中的消息 (最多等待 timeout 秒)，然后停止发送协程并落盘进度"""
+        if self._send_queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._send_queues.values())), timeout)
+            except asyncio.TimeoutError:
+                pending = sum(q.qsize() for q in self._send_queues.values())
+                logger.warning(f"关闭时仍有 {pending} 条消息未发送。")
+        for task in self._send_workers.values():
+            task.cancel()
+        await asyncio.gather(*self._send_workers.values(), return_exceptions=True)
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        try:
+            await self.flush_progress()
+        except Exception as e:
+            logger.error(f"关闭时落盘失败，{len(self._pending_hashes)} 条哈希与 {len(self._progress_dirty)} 个频道进度未写入: {e}")
 
     async def process_history(self, resolved_source_ids: List[int]):
-        settings = web_server.rules_db.settings
+        settings = self.rules_db.settings
         if settings.forward_new_only:
             logger.info("根据系统设置，跳过历史消息扫描。")
             return
@@ -258,138 +590,248 @@ class UltimateForwarder:
     # --- 辅助方法 ---
 
     def _apply_replacements(self, text: str) -> str:
-        replacements = web_server.rules_db.replacements
-        if not text or not replacements: return text
-        for find, replace_with in replacements.items():
-            text = text.replace(find, replace_with) 
-        return text
+        if not text or self._repl_re is None: return text
+        if self._repl_table is not None:
+            return text.translate(self._repl_table)
+        repl_map = self._repl_map
+        return self._repl_re.sub(lambda m: repl_map[m.group(0)], text)
 
     def _compile_patterns(self, patterns: List[str]) -> List[re.Pattern]:
-        return [re.compile(p, re.IGNORECASE) for p in patterns]
-
-    def _compile_word_patterns(self, keywords: List[str]) -> List[re.Pattern]:
-        return [re.compile(r'\b' + re.escape(kw) + r'\b', re.IGNORECASE) for kw in keywords]
+        compiled = []
+        for p in patterns:
+            try:
+                compiled.append(re.compile(p, re.IGNORECASE))
+            except re.error as e:
+                logger.warning(f"广告正则 '{p}' 无效，已忽略: {e}")
+        return compiled
+
+    def _compile_word_union(self, keywords: List[str]) -> Optional[re.Pattern]:
+        """所有全词关键词合并为一个 \\b(?:kw1|kw2|...)\\b，一次 search 完成匹配"""
+        if not keywords: return None
+        return re.compile(r'\b(?:' + '|'.join(re.escape(kw) for kw in keywords) + r')\b', re.IGNORECASE)
+
+    def _compile_union(self, patterns: List[re.Pattern]) -> Tuple[Optional[re.Pattern], List[str], List[re.Pattern]]:
+        """
+        把广告正则合并为一个带命名分组的交替式 (?P<g0>p0)|(?P<g1>p1)|...，
+        一次 search 扫描全部模式，命中后通过 lastgroup 找回原始模式。
+        返回 (合并后的正则, 分组序号 -> 原始模式, 无法合并而需逐个匹配的正则)。
+        """
+        mergeable = [p for p in patterns if not _NUMBERED_BACKREF.search(p.pattern)]
+        residual = [p for p in patterns if _NUMBERED_BACKREF.search(p.pattern)]
+        if not mergeable: return None, [], residual
+        sources = [p.pattern for p in mergeable]
+        union_src = '|'.join(f'(?P<g{i}>{src})' for i, src in enumerate(sources))
+        try:
+            union = re.compile(union_src, re.IGNORECASE)
+        except re.error:
+            # 模式自带重名分组或行内全局标志等无法合并的情况，退回逐个匹配
+            return None, [], patterns
+        if re2 is not None and not any(_RE2_ASCII_ESCAPE.search(src) for src in sources):
+            try:
+                # RE2 不支持环视等特性，编译失败时保留 re 版本
+                union = re2.compile('(?i)' + union_src)
+            except Exception:
+                logger.debug("广告正则包含 RE2 不支持的语法，继续使用 re 引擎。")
+        return union, sources, residual
 
-    def _should_filter(self, text: str, media: Any) -> Tuple[Optional[str], Optional[str]]: 
-        """检查消息是否应该被过滤，返回 (原因, 匹配的关键词)"""
-        text = text or ""
-        text_lower = text.lower()
-        
-        whitelist = web_server.rules_db.whitelist
-        ad_filter = web_server.rules_db.ad_filter
-        content_filter = web_server.rules_db.content_filter
+    def _should_filter(self, text: str, text_lower: str, media: Any, file_name: Optional[str]) -> Tuple[Optional[str], Optional[str]]: 
+        """检查消息是否应该被过滤，返回 (原因, 匹配的关键词)；text_lower / file_name 由调用方预先计算"""
         
-        # 1. 白名单检查 (最高优先级)
-        if whitelist and whitelist.enable:
-            if any(kw.lower() in text_lower for kw in (whitelist.keywords or [])):
+        # 1. 白名单检查 (最高优先级)；空文本不可能命中任何关键词
+        if text_lower and self._whitelist_enabled:
+            if self._whitelist_matcher.find(text_lower):
                 return None, None 
 
-        # 2. 广告黑名单检查
-        if ad_filter and ad_filter.enable:
-            # 子字符串匹配
-            if ad_filter.keywords_substring:
-                for kw in ad_filter.keywords_substring:
-                    if kw.lower() in text_lower:
-                        return "Blacklist (Substring)", kw
-            
-            # 全词匹配 (Regex Word Boundary)
-            for p in self.ad_keyword_word_patterns:
-                match = p.search(text)
-                if match: 
-                    return "Blacklist (Word)", match.group(0)
-            
-            # 正则表达式匹配
-            for p in self.ad_patterns:
-                match = p.search(text)
-                if match: 
-                    return "Blacklist (Regex)", p.pattern
-            
-            # 文件名匹配
-            if ad_filter.file_name_keywords and media and isinstance(media, MessageMediaDocument):
-                 doc = media.document
-                 if doc:
-                    file_name = next((attr.file_name for attr in doc.attributes if hasattr(attr, 'file_name')), None)
-                    if file_name:
-                        for kw in ad_filter.file_name_keywords:
-                            if kw.lower() in file_name.lower():
-                                return "Blacklist (Filename)", kw
-
-        # 3. 内容质量过滤
-        if content_filter and content_filter.enable:
+        # 2. 内容质量过滤：只做长度/集合判断，成本最低，先于任何关键词扫描执行
+        if self._content_filter_enabled:
             if not text and not media: 
                 return "Empty", "No Content"
-            if text_lower in ([w.lower() for w in content_filter.meaningless_words] or []):
+            if text_lower in self._meaningless_set:
                 return "Meaningless", text
-            if not media and len(text.strip()) < content_filter.min_meaningful_length:
+            if not media and len(text.strip()) < self._min_meaningful_length:
                 return "Too Short", f"Len: {len(text.strip())}"
 
+        # 3. 广告黑名单检查：按成本从低到高 (AC 自动机 -> 单词正则 -> 自定义正则)
+        if self._ad_filter_enabled:
+            # 子字符串匹配 (Aho-Corasick)；纯媒体消息 (无文本) 非常常见，直接跳过所有文本扫描
+            if text_lower:
+                kw = self._ad_sub_matcher.find(text_lower)
+                if kw:
+                    return "Blacklist (Substring)", kw
+            
+            # 文件名匹配 (Aho-Corasick，文件名很短)
+            if file_name and self._ad_file_matcher:
+                kw = self._ad_file_matcher.find(file_name.lower())
+                if kw:
+                    return "Blacklist (Filename)", kw
+            
+            if text_lower:
+                # 全词匹配：先分词做集合查找，再用正则处理其余关键词
+                if self._ad_word_set:
+                    tokens = _WORD_RE.findall(text_lower)
+                    if not self._ad_word_set.isdisjoint(tokens):
+                        return "Blacklist (Word)", next(t for t in tokens if t in self._ad_word_set)
+                if self._ad_word_union and self._ad_word_prefilter.find(text_lower):
+                    match = self._ad_word_union.search(text)
+                    if match: 
+                        return "Blacklist (Word)", match.group(0)
+                
+                # 正则表达式匹配
+                if self._ad_union and (self._ad_union_prefilter is None or self._ad_union_prefilter.find(text_lower)):
+                    match = self._ad_union.search(text)
+                    if match: 
+                        return "Blacklist (Regex)", self._ad_union_sources[int(match.lastgroup[1:])]
+                for p, literal in zip(self._ad_residual, self._ad_residual_literals):
+                    if literal and literal not in text_lower:
+                        continue
+                    match = p.search(text)
+                    if match: 
+                        return "Blacklist (Regex)", p.pattern
+
         return None, None
 
     def _get_message_hash(self, message_data: Dict[str, Any]) -> Optional[str]:
         if not self.config.deduplication.enable: return None
         media = message_data.get('media')
         if media:
-            if hasattr(media, 'photo'): return f"photo:{media.photo.id}"
-            if hasattr(media, 'document'): return f"doc:{media.document.id}:{getattr(media.document, 'size', '0')}"
+            if isinstance(media, MessageMediaPhoto) and media.photo: return f"photo:{media.photo.id}"
+            if isinstance(media, MessageMediaDocument) and media.document: return f"doc:{media.document.id}:{getattr(media.document, 'size', '0')}"
         text = message_data.get('text', "")
-        if len(text) > 50: return f"text:{hash(text)}"
+        # 使用稳定摘要：内置 hash() 每个进程随机加盐，重启后去重记录全部失效
+        if len(text) > 50: return f"text:{_text_digest(text)}"
         return f"id:{message_data.get('hash_source')}"
 
+    def _get_message_hashes(self, message_data: Dict[str, Any]) -> List[str]:
+        """相册按每个子项分别计算哈希，任一子项重复即视为整组重复；结果缓存在 message_data 中，查重与标记共用"""
+        cached = message_data.get('_hashes')
+        if cached is not None: return cached
+        group = message_data.get('group')
+        if not group:
+            msg_hash = self._get_message_hash(message_data)
+            hashes = [msg_hash] if msg_hash else []
+        else:
+            group_hashes = (self._get_message_hash({"text": m.text or "", "media": m.media, "hash_source": m.id}) for m in group)
+            hashes = list(dict.fromkeys(h for h in group_hashes if h))
+        message_data['_hashes'] = hashes
+        return hashes
+
     async def _is_duplicate(self, message_data: Dict[str, Any], log_id: str) -> bool:
         if not self.config.deduplication.enable: return False
-        msg_hash = self._get_message_hash(message_data)
-        if not msg_hash: return False
-        return await database.check_hash(msg_hash)
+        hashes = self._get_message_hashes(message_data)
+        if not hashes: return False
+        for msg_hash in hashes:
+            if msg_hash in self._inflight_hashes:
+                return True
+            if msg_hash in self._hash_cache:
+                self._hash_cache.move_to_end(msg_hash)
+                return True
+        # 注意：check_hashes 在数据库异常时也视为已存在，因此数据库结果不写入缓存
+        if len(hashes) == 1:
+            return await database.check_hash(hashes[0])
+        return bool(await database.check_hashes(hashes))
 
     async def _mark_as_processed(self, message_data: Dict[str, Any]):
         if not self.config.deduplication.enable: return
-        msg_hash = self._get_message_hash(message_data)
-        if msg_hash: await database.add_hash(msg_hash)
-
-    def _find_target(self, text: str, media: Any) -> Tuple[Optional[int], Optional[int]]:
-        for rule in web_server.rules_db.distribution_rules:
-            if rule.check(text, media): 
-                logger.debug(f"命中分发规则: '{rule.name}'")
+        hashes = self._get_message_hashes(message_data)
+        if not hashes: return
+        self._pending_hashes.extend(hashes)
+        self._ensure_flush_worker()
+        for msg_hash in hashes:
+            self._remember_hash(msg_hash)
+
+    def _remember_hash(self, msg_hash: str):
+        self._hash_cache[msg_hash] = None
+        self._hash_cache.move_to_end(msg_hash)
+        if len(self._hash_cache) > self._hash_cache_max:
+            self._hash_cache.popitem(last=False)
+
+    def _find_target(self, text: str, text_lower: str, mime_type: Optional[str], file_name: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+        key = (text, mime_type, file_name)
+        cached = self._target_cache.get(key)
+        if cached is not None: return cached
+        
+        result = self._match_target(text_lower, mime_type, file_name)
+        self._target_cache[key] = result
+        if len(self._target_cache) > self._target_cache_max:
+            self._target_cache.popitem(last=False)
+        return result
+
+    def _document_info(self, media: Any) -> Tuple[Optional[str], Optional[str]]:
+        """返回文档的 (MIME 类型, 文件名)；非文档媒体返回 (None, None)"""
+        if not isinstance(media, MessageMediaDocument) or not media.document:
+            return None, None
+        doc = media.document
+        file_name = next((attr.file_name for attr in doc.attributes if isinstance(attr, DocumentAttributeFilename)), None)
+        return doc.mime_type, file_name
+
+    def _match_target(self, text_lower: str, mime_type: Optional[str], file_name: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+        hits = self._rule_kw_matcher.find_all(text_lower) if text_lower and self._rule_kw_matcher else set()
+        mime_lower = mime_type.lower() if mime_type else None
+        for compiled in self._rule_buckets[(bool(text_lower), bool(mime_lower or file_name))]:
+            if compiled.matches(hits, mime_lower, file_name): 
+                rule = compiled.rule
+                logger.debug("命中分发规则: '{}'", rule.name)
                 return rule.resolved_target_id, rule.topic_id
         
-        settings = web_server.rules_db.settings
-        return self.config.targets.resolved_default_target_id, settings.default_topic_id
+        return self.config.targets.resolved_default_target_id, self._default_topic_id
 
-    async def _send_message(self, original_message: Union[Message, List[Message]], message_data: Dict[str, Any], target_id: int, topic_id: Optional[int]):
-        text = message_data['text']
-        settings = web_server.rules_db.settings
-        mode = settings.forwarding_mode
-        
+    async def _send_message(self, original_message: Union[Message, List[Message]], message_data: Dict[str, Any], target_id: int, topic_id: Optional[int]) -> bool:
+        """发送一条 (或一组) 消息，成功返回 True；熔断跳过或最终失败返回 False，调用方据此决定是否记入去重"""
         send_kwargs = {}
         if topic_id: send_kwargs["reply_to"] = topic_id
+        
+        # 按转发模式预先生成发送函数 (媒体类型只判断一次)，重试时直接复用
+        do_send = self._prepare_send(original_message, message_data['text'], target_id, send_kwargs)
             
-        client = self._get_next_client()
+        client = await self._get_next_client(target_id)
+        if client is None:
+            logger.warning(f"所有客户端对目标 {target_id} 均已熔断，跳过本条消息。")
+            return False
+        client_key = client.session_name_for_forwarder
+        
+        for attempt in range(_SEND_RETRIES):
+            try:
+                await self.client_buckets[client_key].acquire()
+                sent_message = await do_send(client)
+                if self._mark_target_read_enabled and sent_message:
+                    await self._mark_target_read(client, target_id, sent_message, topic_id)
+
+                breaker = self._breakers.get((client_key, target_id))
+                if breaker: breaker.record_success()
+                return True
+            except _TRANSIENT_SEND_ERRORS as e:
+                # 网络抖动 / 服务端 5xx / 超时：指数退避 + 随机抖动后重试，避免直接丢消息
+                if attempt == _SEND_RETRIES - 1:
+                    await self._handle_send_error(e, client, target_id)
+                    return False
+                delay = min(30, 2 ** attempt) + random.uniform(0, 1)
+                logger.warning(f"发送到 {target_id} 出现临时错误 ({type(e).__name__})，{delay:.1f} 秒后重试 ({attempt + 1}/{_SEND_RETRIES})")
+                await asyncio.sleep(delay)
+            except Exception as e:
+                # FloodWait 与永久性错误 (无权限 / 被封禁等) 不重试
+                await self._handle_send_error(e, client, target_id)
+                return False
+        return False
+
+    def _prepare_copy(self, original_message: Union[Message, List[Message]], text: str, target_id: int, send_kwargs: Dict[str, Any]) -> Callable[[TelegramClient], Awaitable[Any]]:
+        """复制模式：重新发送文本/媒体"""
+        if isinstance(original_message, list):
+            media_list = [msg.media for msg in original_message if msg.media]
+            if media_list:
+                # 相册整组一次发送 (Telethon 自动分组)，文本仅作为第一项的说明
+                return lambda client: client.send_file(target_id, file=media_list, caption=text, **send_kwargs)
+        elif isinstance(original_message, Message):
+            media = original_message.media
+            if media and not isinstance(media, MessageMediaWebPage):
+                return lambda client: client.send_message(target_id, message=text, file=media, **send_kwargs)
+        return lambda client: client.send_message(target_id, message=text, file=None, parse_mode='md', **send_kwargs)
+
+    def _prepare_forward(self, original_message: Union[Message, List[Message]], text: str, target_id: int, send_kwargs: Dict[str, Any]) -> Callable[[TelegramClient], Awaitable[Any]]:
+        """转发模式：保留原始来源"""
+        return lambda client: client.forward_messages(target_id, messages=original_message, **send_kwargs)
+
+    async def _mark_target_read(self, client: TelegramClient, target_id: int, sent_message: Union[Message, List[Message]], topic_id: Optional[int]):
         try:
-            sent_message = None
-            if mode == 'copy':
-                media_to_send = None
-                is_real_file = False
-                if isinstance(original_message, list):
-                    media_to_send = [msg.media for msg in original_message if msg.media]
-                    is_real_file = True 
-                elif isinstance(original_message, Message):
-                    media = original_message.media
-                    if media and not isinstance(media, MessageMediaWebPage):
-                        is_real_file = True
-                        media_to_send = media
-                
-                if is_real_file:
-                    sent_message = await client.send_message(target_id, message=text, file=media_to_send, **send_kwargs)
-                else:
-                    sent_message = await client.send_message(target_id, message=text, file=None, parse_mode='md', **send_kwargs)
-            else:
-                sent_message = await client.forward_messages(target_id, messages=original_message, **send_kwargs)
-            
-            if settings.mark_target_as_read and sent_message:
-                try:
-                    last_id = sent_message[-1].id if isinstance(sent_message, list) else sent_message.id
-                    await client.mark_read(target_id, max_id=last_id, top_msg_id=topic_id)
-                except: pass
-
-        except Exception as e:
-             await self._handle_send_error(e, client)
\ No newline at end of file
+            last_id = sent_message[-1].id if isinstance(sent_message, list) else sent_message.id
+            await client.mark_read(target_id, max_id=last_id, top_msg_id=topic_id)
+        except: pass
\ No newline at end of file
@@ -0,0 +1,45 @@
+# keyword_matcher.py
+from typing import Iterable, Optional, Set, Tuple
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+class KeywordMatcher:
+    """
+    小写关键词集合的多模式子串匹配。
+    安装了 pyahocorasick 时构建 Aho-Corasick 自动机，一次线性扫描即可完成匹配，
+    耗时与关键词数量无关；未安装时退回逐个 `in` 判断。
+    """
+
+    def __init__(self, keywords: Iterable[str]):
+        # 去重并保持顺序；空关键词会命中任意文本，视为配置残留直接忽略
+        self.keywords: Tuple[str, ...] = tuple(dict.fromkeys(kw.lower() for kw in keywords if kw))
+        self._automaton = None
+        if ahocorasick and self.keywords:
+            automaton = ahocorasick.Automaton()
+            for kw in self.keywords:
+                automaton.add_word(kw, kw)
+            automaton.make_automaton()
+            self._automaton = automaton
+
+    def __bool__(self) -> bool:
+        return bool(self.keywords)
+
+    def find(self, text_lower: str) -> Optional[str]:
+        """返回文本 (已小写) 中出现的任意一个关键词，未命中返回 None"""
+        if self._automaton is not None:
+            for _, kw in self._automaton.iter(text_lower):
+                return kw
+            return None
+        for kw in self.keywords:
+            if kw in text_lower:
+                return kw
+        return None
+
+    def find_all(self, text_lower: str) -> Set[str]:
+        """返回文本 (已小写) 中出现的全部关键词集合"""
+        if self._automaton is not None:
+            return {kw for _, kw in self._automaton.iter(text_lower)}
+        return {kw for kw in self.keywords if kw in text_lower}
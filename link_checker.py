@@ -5,10 +5,11 @@ import httpx
 import json
 import os
 from telethon import TelegramClient
-from telethon.errors import RPCError
+from telethon.errors import RPCError, FloodWaitError
 from bs4 import BeautifulSoup
 import re
-from typing import List, Dict, Any
+from collections import defaultdict
+from typing import List, Dict, Any, Optional
 # (新) v8.5：从 models.py 导入
 from models import Config
 from datetime import datetime, timezone 
@@ -17,11 +18,25 @@ import database
 
 from loguru import logger
 
+try:
+    import h2  # noqa: F401  httpx 的 HTTP/2 支持依赖 h2
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
 # 基于 TGNetDiskLinkChecker.py 优化
 
+# 扫描频道时每页拉取的消息数
+_SCAN_PAGE_SIZE = 200
+# 编辑模式下追加在失效链接后的标记
+_INVALID_MARK = " [链接已失效]"
+
 class LinkChecker:
     def __init__(self, config: Config, client: TelegramClient):
         self.client = client
+        # 共享 HTTP 客户端与并发信号量，只在 run() 检测期间存在
+        self._http: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
         self.reload(config) 
         
     def reload(self, config: Config):
@@ -36,6 +51,9 @@ class LinkChecker:
             'pan.quark.cn', 'aliyundrive.com', 'alipan.com',
             '115.com', 'pan.baidu.com', 'cloud.189.cn', 'drive.uc.cn'
         ]
+        # URL 与网盘域名合并为一个正则：只有包含网盘域名的 URL 才会被匹配，整条消息一次 findall 完成
+        domains = '|'.join(re.escape(d) for d in self.net_disk_domains)
+        self._link_re = re.compile(rf'https?://\S*(?:{domains})\S*')
         
         logger.info("链接检测器配置已重载。")
     
@@ -43,27 +61,56 @@ class LinkChecker:
         """从消息文本中提取网盘链接"""
         if not message_text:
             return []
-        url_pattern = r'https://?[^\s]+'
-        urls = re.findall(url_pattern, message_text)
-        links = [url for url in urls if any(domain in url for domain in self.net_disk_domains)]
-        return list(set(links)) # 去重
+        return list(set(self._link_re.findall(message_text))) # 去重
+
+    @staticmethod
+    def _mark_invalid_links(text: str, links: List[str]) -> str:
+        """一次扫描给所有失效链接追加标记；已带标记的链接保持不变，重复执行结果相同"""
+        # 长链接优先，避免某个链接是另一个链接前缀时只标记了较短的那个
+        pattern = re.compile('|'.join(re.escape(link) for link in sorted(links, key=len, reverse=True)))
+        def repl(m: re.Match) -> str:
+            if text.startswith(_INVALID_MARK, m.end()):
+                return m.group(0)
+            return m.group(0) + _INVALID_MARK
+        return pattern.sub(repl, text)
+
+    @staticmethod
+    def _new_http_client() -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            timeout=10.0, follow_redirects=True, http2=_HTTP2, headers={"User-Agent": "Mozilla/5.0"},
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
 
     async def _check_link_validity(self, url: str) -> bool:
         """
         检查单个链接的有效性 (简化版)。
         """
+        if self._http is None:
+            # 不在 run() 中调用时 (如单独检测一个链接) 使用临时客户端
+            async with self._new_http_client() as http:
+                return await self._probe_link(http, url)
+        async with self._semaphore:
+            return await self._probe_link(self._http, url)
+
+    async def _probe_link(self, http: httpx.AsyncClient, url: str) -> bool:
         try:
-            async with httpx.AsyncClient(timeout=10.0, follow_redirects=True) as client:
-                response = await client.head(url, headers={"User-Agent": "Mozilla/5.0"})
-                
-                if response.status_code == 404:
-                    logger.debug(f"Link check (HEAD) {url} -> 404 Not Found")
-                    return False
-                if response.status_code >= 400:
-                     logger.debug(f"Link check (HEAD) {url} -> {response.status_code}")
-                     return False
-                
-                return True
+            # 不少网盘拒绝 HEAD (返回 403/405)，改用只取首字节的 GET；
+            # 以流方式发送，只读取状态码就关闭，服务端忽略 Range 时也不会下载整个响应体
+            async with http.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+                status = response.status_code
+            if status == 403:
+                # 部分站点不接受 Range 请求，去掉 Range 再试一次
+                async with http.stream("GET", url) as response:
+                    status = response.status_code
+            
+            if status in (404, 410):
+                logger.debug("Link check (GET) {} -> {} Not Found", url, status)
+                return False
+            if status >= 400:
+                 logger.debug("Link check (GET) {} -> {}", url, status)
+                 return False
+            
+            return True
         except httpx.RequestError as e:
             logger.warning(f"检测链接 {url} 时发生网络错误: {e}")
             return True # 网络错误，暂时认为有效
@@ -94,19 +141,19 @@ class LinkChecker:
         
         new_links_found = 0
         try:
-            async for message in self.client.iter_messages(self.target_channel_id, min_id=last_processed_id):
-                if not message.text: 
-                    continue
-                
-                links = self._extract_links(message.text)
-                if links:
-                    for link in links:
-                        await database.add_pending_link(link, message.id)
-                        new_links_found += 1 
-                
-                last_processed_id = max(last_processed_id, message.id)
-
-            await database.set_link_checker_progress(last_processed_id)
+            # 从旧到新按页拉取，每页的新链接批量写入后立即保存进度，中断时最多重扫一页
+            while True:
+                batch = await self.client.get_messages(self.target_channel_id, limit=_SCAN_PAGE_SIZE, min_id=last_processed_id, reverse=True)
+                if not batch:
+                    break
+                pending_rows = []
+                for message in batch:
+                    if message.text:
+                        pending_rows.extend((link, message.id) for link in self._extract_links(message.text))
+                await database.add_pending_links(pending_rows)
+                new_links_found += len(pending_rows)
+                last_processed_id = max(last_processed_id, max(m.id for m in batch))
+                await database.set_link_checker_progress(last_processed_id)
             logger.info(f"频道扫描完成，发现 {new_links_found} 个新链接（或已存在）。")
 
         except Exception as e:
@@ -115,19 +162,22 @@ class LinkChecker:
         links_to_check = await database.get_links_to_check()
         logger.info(f"总共有 {len(links_to_check)} 个链接需要检测...")
 
-        invalid_messages: Dict[int, List[str]] = {} 
+        invalid_messages: Dict[int, List[str]] = defaultdict(list)
 
-        for (link, msg_id) in links_to_check:
-            is_valid = await self._check_link_validity(link)
-            
-            if is_valid:
-                await database.update_link_status(link, 'valid')
-            else:
-                await database.update_link_status(link, 'invalid')
+        # 整轮检测共用一个连接池，并发数由信号量限制 (避免每个链接重新握手 TLS)
+        self._semaphore = asyncio.Semaphore(max(1, self.checker_config.concurrency))
+        async with self._new_http_client() as http:
+            self._http = http
+            try:
+                results = await asyncio.gather(*(self._check_link_validity(link) for link, _ in links_to_check))
+            finally:
+                self._http = None
+
+        await database.update_link_statuses([(link, 'valid' if is_valid else 'invalid') for (link, _), is_valid in zip(links_to_check, results)])
+        for (link, msg_id), is_valid in zip(links_to_check, results):
+            if not is_valid:
                 logger.warning(f"检测到失效链接: {link} (Message ID: {msg_id})")
                 
-                if msg_id not in invalid_messages:
-                    invalid_messages[msg_id] = []
                 invalid_messages[msg_id].append(link)
 
         if self.checker_config.mode == "log":
@@ -135,32 +185,53 @@ class LinkChecker:
             
         elif self.checker_config.mode == "edit":
             logger.info("正在编辑包含失效链接的消息...")
-            for msg_id, links in invalid_messages.items():
+            msg_ids = list(invalid_messages)
+            edits = []
+            # 按 ID 批量取回消息，每次请求最多 100 条
+            for i in range(0, len(msg_ids), 100):
+                chunk = msg_ids[i:i + 100]
                 try:
-                    message = await self.client.get_messages(self.target_channel_id, ids=msg_id)
+                    messages = await self.client.get_messages(self.target_channel_id, ids=chunk)
+                except Exception as e:
+                    logger.error(f"获取消息 {chunk[0]}..{chunk[-1]} 失败: {e}")
+                    continue
+                for msg_id, message in zip(chunk, messages):
                     if not message or not message.text:
                         continue
-                    
-                    if "[链接已失效]" in message.text:
-                        logger.debug(f"消息 {msg_id} 已被标记，跳过。")
+                    new_text = self._mark_invalid_links(message.text, invalid_messages[msg_id])
+                    if new_text == message.text:
+                        logger.debug("消息 {} 已被标记，跳过。", msg_id)
                         continue
-
-                    new_text = message.text
-                    for link in links:
-                        new_text = new_text.replace(link, f"{link} [链接已失效]")
-                        
-                    await self.client.edit_message(self.target_channel_id, msg_id, new_text)
-                    logger.info(f"已编辑消息 {msg_id}")
-                except Exception as e:
-                    logger.error(f"编辑消息 {msg_id} 失败: {e}")
+                    edits.append((msg_id, new_text))
+
+            # 编辑请求少量并发，遇到 FloodWait 按服务端要求等待后重试一次
+            sem = asyncio.Semaphore(3)
+            async def do_edit(msg_id: int, new_text: str):
+                async with sem:
+                    try:
+                        try:
+                            await self.client.edit_message(self.target_channel_id, msg_id, new_text)
+                        except FloodWaitError as e:
+                            logger.warning(f"编辑消息触发 FloodWait，等待 {e.seconds} 秒。")
+                            await asyncio.sleep(e.seconds)
+                            await self.client.edit_message(self.target_channel_id, msg_id, new_text)
+                        logger.info(f"已编辑消息 {msg_id}")
+                    except Exception as e:
+                        logger.error(f"编辑消息 {msg_id} 失败: {e}")
+            await asyncio.gather(*(do_edit(msg_id, new_text) for msg_id, new_text in edits))
 
         elif self.checker_config.mode == "delete":
             logger.info("正在删除包含失效链接的消息...")
             msg_ids_to_delete = list(invalid_messages.keys())
-            try:
-                await self.client.delete_messages(self.target_channel_id, msg_ids_to_delete)
-                logger.info(f"已删除 {len(msg_ids_to_delete)} 条消息。")
-            except RPCError as e:
-                logger.error(f"批量删除消息失败: {e}")
+            deleted = 0
+            # 每次请求最多删除 100 条，单批失败不影响其余批次
+            for i in range(0, len(msg_ids_to_delete), 100):
+                chunk = msg_ids_to_delete[i:i + 100]
+                try:
+                    await self.client.delete_messages(self.target_channel_id, chunk)
+                    deleted += len(chunk)
+                except RPCError as e:
+                    logger.error(f"批量删除消息失败: {e}")
+            logger.info(f"已删除 {deleted} 条消息。")
 
         logger.info("--- 失效链接检测器运行完毕 ---")
\ No newline at end of file
@@ -1,11 +1,14 @@
 # models.py
 import logging
 import re
-from typing import List, Optional, Dict, Any, Union 
-from pydantic import BaseModel, Field, field_validator, model_validator
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Union, Tuple, Set 
+from pydantic import BaseModel, Field, PrivateAttr, field_validator, model_validator
 
 from loguru import logger
 
+from keyword_matcher import KeywordMatcher
+
 # --- 日志配置模型 ---
 class LoggingLevelConfig(BaseModel):
     app: str = "INFO"
@@ -56,6 +59,41 @@ class SourceConfig(BaseModel):
     # (新增) 缓存的真实标题
     cached_title: Optional[str] = None
 
+@dataclass(slots=True)
+class CompiledRule:
+    """分发规则的运行时形态：只保留匹配所需的预处理字段，热路径上避免 Pydantic 属性访问开销"""
+    rule: "TargetDistributionRule"
+    all_required: frozenset
+    any_set: frozenset
+    file_types_lower: Tuple[str, ...]
+    name_substrings: Tuple[str, ...]
+    name_regex: Optional[re.Pattern]
+    has_or: bool
+
+    def matches(self, hits: Set[str], mime_lower: Optional[str], file_name: Optional[str]) -> bool:
+        """hits 为文本中出现的关键词集合 (已小写)；非文档消息的 mime_lower/file_name 为 None"""
+        # 1. 检查 [AND] all_keywords
+        if self.all_required and not self.all_required <= hits:
+            return False
+        
+        # 2. 检查 [OR] 条件组
+        if not self.has_or:
+            return True
+        if self.any_set and not self.any_set.isdisjoint(hits):
+            return True
+        if mime_lower and self.file_types_lower:
+            # 包含语义：video/、pdf 以及完整的 application/pdf 都按子串判断
+            if any(ft in mime_lower for ft in self.file_types_lower):
+                return True
+        if file_name:
+            if self.name_substrings:
+                name_lower = file_name.lower()
+                if any(sub in name_lower for sub in self.name_substrings):
+                    return True
+            if self.name_regex is not None and self.name_regex.search(file_name):
+                return True
+        return False
+
 class TargetDistributionRule(BaseModel):
     name: str 
     all_keywords: List[str] = Field(default_factory=list) # AND 关系
@@ -68,46 +106,63 @@ class TargetDistributionRule(BaseModel):
     
     resolved_target_id: Optional[int] = None
     
+    # 预处理结果：小写关键词与编译好的文件名模式，避免每条消息重复计算
+    _keyword_matcher: KeywordMatcher = PrivateAttr(default_factory=lambda: KeywordMatcher(()))
+    _compiled: Optional[CompiledRule] = PrivateAttr(default=None)
+    
+    @model_validator(mode='after')
+    def precompile(self):
+        self._keyword_matcher = KeywordMatcher(self.all_keywords + self.any_keywords)
+        # 文件名模式是不锚定的包含匹配，首尾的 * 不起作用：中间不含 * 的模式
+        # (如 *.pdf、report*) 等价于普通子串判断，只有中间带 * 的才需要正则
+        substrings, patterns = [], []
+        for pattern_str in self.file_name_patterns:
+            core = pattern_str.strip('*')
+            if '*' not in core:
+                substrings.append(core.lower())
+                continue
+            try:
+                source = re.escape(pattern_str).replace(r'\*', r'.*')
+                re.compile(source)
+            except re.error:
+                logger.warning(f"规则 '{self.name}' 中的文件名模式 '{pattern_str}' 无效")
+                continue
+            patterns.append(f'(?:{source})')
+        self._compiled = CompiledRule(
+            rule=self,
+            all_required=frozenset(kw.lower() for kw in self.all_keywords if kw),
+            any_set=frozenset(kw.lower() for kw in self.any_keywords if kw),
+            file_types_lower=tuple(dict.fromkeys(ft.lower() for ft in self.file_types)),
+            name_substrings=tuple(substrings),
+            # 多个通配模式合并为一个正则，一次 search 完成匹配
+            name_regex=re.compile('|'.join(patterns), re.IGNORECASE) if patterns else None,
+            has_or=bool(self.any_keywords or self.file_types or self.file_name_patterns),
+        )
+        return self
+    
+    @property
+    def compiled(self) -> CompiledRule:
+        return self._compiled
+
+    @property
+    def keywords(self) -> frozenset:
+        """规则涉及的全部小写关键词 (供转发器构建全局索引)"""
+        return self._compiled.all_required | self._compiled.any_set
+
     def check(self, text: str, media: Any) -> bool:
         text_lower = text.lower() if text else ""
         
-        # 1. 检查 [AND] all_keywords
-        if self.all_keywords:
-            if not all(kw.lower() in text_lower for kw in self.all_keywords):
-                return False 
-        
-        # 2. 检查 [OR] 条件组
-        has_or_conditions = bool(self.any_keywords or self.file_types or self.file_name_patterns)
-        if not has_or_conditions:
-            return True
-
-        if self.any_keywords:
-            if any(keyword.lower() in text_lower for keyword in self.any_keywords):
-                return True
-        
         try:
-            from telethon.tl.types import MessageMediaDocument
+            from telethon.tl.types import MessageMediaDocument, DocumentAttributeFilename
         except ImportError:
-            MessageMediaDocument = None
+            MessageMediaDocument = DocumentAttributeFilename = None
 
-        if MessageMediaDocument and media and isinstance(media, MessageMediaDocument):
+        mime_lower = file_name = None
+        if MessageMediaDocument and media and isinstance(media, MessageMediaDocument) and media.document:
             doc = media.document
-            if doc:
-                if self.file_types and doc.mime_type:
-                    if any(ft.lower() in doc.mime_type.lower() for ft in self.file_types):
-                        return True
-
-                if self.file_name_patterns:
-                    file_name = next((attr.file_name for attr in doc.attributes if hasattr(attr, 'file_name')), None)
-                    if file_name:
-                        for pattern_str in self.file_name_patterns:
-                            try:
-                                pattern = re.compile(re.escape(pattern_str).replace(r'\*', r'.*'), re.IGNORECASE)
-                                if re.search(pattern, file_name):
-                                    return True
-                            except re.error:
-                                logger.warning(f"规则 '{self.name}' 中的文件名模式 '{pattern_str}' 无效")
-        return False
+            mime_lower = doc.mime_type.lower() if doc.mime_type else None
+            file_name = next((attr.file_name for attr in doc.attributes if isinstance(attr, DocumentAttributeFilename)), None)
+        return self._compiled.matches(self._keyword_matcher.find_all(text_lower), mime_lower, file_name)
 
 class TargetConfig(BaseModel):
     default_target: Union[int, str]
@@ -159,6 +214,7 @@ class LinkCheckerConfig(BaseModel):
     enabled: bool = False
     mode: str = "log" 
     schedule: str = "0 3 * * *" 
+    concurrency: int = 20  # 同时检测的链接数
 
 class BotServiceConfig(BaseModel):
     enabled: bool = False
@@ -170,6 +226,9 @@ class ForwardingConfig(BaseModel): # 保留用于读取旧配置
     forward_new_only: bool = True
     mark_as_read: bool = False
     mark_target_as_read: bool = False
+    # 每个账号的主动限速 (令牌桶)，低于 Telegram 服务端阈值以避免触发 FloodWait
+    send_rate: float = 25.0  # 每秒补充的令牌数，<= 0 表示不限速
+    send_burst: int = 20     # 桶容量 (允许的突发条数)
 
 class Config(BaseModel):
     docker_container_name: Optional[str] = "tg-forwarder"
@@ -0,0 +1,41 @@
+# tests/test_ad_union.py
+import re
+
+import pytest
+
+pytest.importorskip("telethon")
+pytest.importorskip("loguru")
+pytest.importorskip("pydantic")
+pytest.importorskip("aiosqlite")
+pytest.importorskip("xxhash")
+
+import forwarder_core
+from forwarder_core import UltimateForwarder
+
+
+def _union(*patterns):
+    union, _, _ = UltimateForwarder._compile_union(None, [re.compile(p, re.IGNORECASE) for p in patterns])
+    return union
+
+
+def test_full_width_digits_match_with_d():
+    # RE2 的 \d 只匹配 ASCII，含 \d 的模式必须留在 re 引擎上
+    union = _union(r'\d{3}-tel', r'spam')
+    assert union.search("１２３-tel") is not None
+
+
+def test_word_escapes_match_cjk():
+    union = _union(r'\w+币', r'foo')
+    assert union.search("比特币") is not None
+
+
+@pytest.mark.parametrize("pattern, expected", [
+    (r'\d{3}', True),
+    (r'\bfoo', True),
+    (r'[\W]+', True),
+    (r'a\\\s', True),
+    (r'a\\d', False),   # 被转义的反斜杠后跟普通字母 d
+    (r'\.com', False),
+])
+def test_ascii_only_escape_detection(pattern, expected):
+    assert bool(forwarder_core._RE2_ASCII_ESCAPE.search(pattern)) is expected
@@ -9,6 +9,12 @@ from datetime import datetime, timezone
 
 from loguru import logger
 
+# uvloop (libuv) 替换默认事件循环，降低每次 await 的调度开销；Windows 不支持，回退到默认循环
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 from telethon import TelegramClient, events, errors
 from telethon.tl.types import Channel, Chat
 
@@ -32,6 +38,7 @@ bot_service_instance = None
 DOCKER_CONTAINER_NAME = "tgf"
 CONFIG_PATH = "/app/config.yaml"
 START_TIME = datetime.now(timezone.utc)
+_config_cache = None # ((路径, mtime_ns, 大小), Config)
 
 class InterceptHandler(logging.Handler):
     def emit(self, record):
@@ -68,14 +75,21 @@ def setup_logging(app_level: str = "INFO", telethon_level: str = "WARNING"):
     logger.success(f"日志系统初始化完成 (App: {app_level}, Telethon: {telethon_level})")
 
 def load_config(path):
-    global DOCKER_CONTAINER_NAME
+    global DOCKER_CONTAINER_NAME, _config_cache
     logger.info(f"正在加载配置: {path}")
     try:
+        # 文件未变化 (路径、mtime、大小均相同) 时复用上次验证过的配置，跳过 YAML 解析和 Pydantic 验证
+        st = os.stat(path)
+        stamp = (path, st.st_mtime_ns, st.st_size)
+        if _config_cache and _config_cache[0] == stamp:
+            logger.info("配置文件未变化，复用已验证的配置。")
+            return _config_cache[1]
         with open(path, 'r', encoding='utf-8') as f:
             config_data = yaml.safe_load(f)
         if 'docker_container_name' in config_data:
             DOCKER_CONTAINER_NAME = config_data['docker_container_name']
         config_obj = Config(**config_data)
+        _config_cache = (stamp, config_obj)
         logger.success("配置文件验证通过。")
         return config_obj
     except FileNotFoundError:
@@ -169,8 +183,8 @@ async def resolve_identifiers(client: TelegramClient, source_list: List[SourceCo
             if not title and hasattr(entity, 'username'):
                 title = entity.username
 
-            if isinstance(entity, Channel) and not str(resolved_id).startswith("-100"): resolved_id = int(f"-100{resolved_id}")
-            elif isinstance(entity, Chat) and not str(resolved_id).startswith("-"): resolved_id = int(f"-{resolved_id}")
+            if isinstance(entity, Channel) and resolved_id > 0: resolved_id = -(10 ** 12 + resolved_id)
+            elif isinstance(entity, Chat) and resolved_id > 0: resolved_id = -resolved_id
             
             # 仅在 ID 变更时才打印日志，减少刷屏
             if s_config.resolved_id != resolved_id:
@@ -241,8 +255,9 @@ async def run_forwarder(config: Config):
         await web_server.load_rules_from_db(config)
         await resolve_identifiers(main_client, web_server.rules_db.sources, "rules_db.json")
 
-        forwarder = UltimateForwarder(config, clients)
+        forwarder = UltimateForwarder(config, clients, web_server.rules_db)
         await forwarder.resolve_targets()
+        web_server.set_rules_listener(forwarder.refresh_rules)
         
         if bot_service_instance:
             bot_service_instance.forwarder = forwarder
@@ -303,11 +318,12 @@ async def export_dialogs(config: Config):
 async def reload_config_func():
     global forwarder, link_checker
     try:
-        new_config = load_config(CONFIG_PATH)
+        # 读取与解析 YAML 是阻塞操作，放到线程中执行，避免热重载期间卡住事件循环
+        new_config = await asyncio.to_thread(load_config, CONFIG_PATH)
         await web_server.load_rules_from_db(new_config)
         if clients:
              await resolve_identifiers(clients[0], web_server.rules_db.sources, "rules_db.json")
-             if forwarder: await forwarder.reload(new_config)
+             if forwarder: await forwarder.reload(new_config, web_server.rules_db)
              if link_checker: link_checker.reload(new_config)
         return "配置热重载成功。"
     except Exception as e: return f"热重载失败: {e}"
@@ -321,6 +337,8 @@ async def main():
     CONFIG_PATH = args.config
     config = load_config(CONFIG_PATH)
     setup_logging(config.logging_level.app, config.logging_level.telethon)
+    loop = asyncio.get_running_loop()
+    logger.info(f"事件循环: {type(loop).__module__}.{type(loop).__name__}")
     if config.web_ui: web_server.set_web_ui_password(config.web_ui.password)
 
     try:
@@ -330,6 +348,7 @@ async def main():
         elif args.mode == 'export': await export_dialogs(config)
     except (KeyboardInterrupt, asyncio.CancelledError): pass
     finally:
+        if forwarder: await forwarder.shutdown()
         if database._db_conn: await database._db_conn.close()
         if bot_client and bot_client.is_connected(): await bot_client.disconnect()
         for c in clients:
@@ -337,5 +356,7 @@ async def main():
 
 if __name__ == "__main__":
     if not os.path.exists("/app/data"): os.makedirs("/app/data", exist_ok=True)
-    try: asyncio.run(main())
+    try:
+        if uvloop: uvloop.run(main())
+        else: asyncio.run(main())
     except KeyboardInterrupt: pass
\ No newline at end of file
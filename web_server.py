@@ -41,9 +41,11 @@ app = FastAPI(
 
 _stats_provider: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None
 _bot_notifier: Optional[Callable[[str], Awaitable[None]]] = None
+_rules_listener: Optional[Callable[[], None]] = None
 
 def set_stats_provider(func): global _stats_provider; _stats_provider = func
 def set_bot_notifier(func): global _bot_notifier; _bot_notifier = func
+def set_rules_listener(func): global _rules_listener; _rules_listener = func
 
 security = HTTPBasic()
 WEB_UI_PASSWORD = "default_password_please_change" 
@@ -62,6 +64,12 @@ async def notify_bot(message: str):
         try: await _bot_notifier(message)
         except: pass
 
+def notify_rules_changed():
+    """通知转发核心刷新其预计算的规则缓存"""
+    if _rules_listener:
+        try: _rules_listener()
+        except Exception as e: logger.error(f"刷新规则缓存失败: {e}")
+
 # --- 核心加载逻辑 (SQLite <-> Pydantic) ---
 
 async def load_rules_from_db(config: Optional[Config] = None): 
@@ -193,6 +201,7 @@ async def get_settings(auth: str = Depends(get_current_user)):
 async def update_settings(settings: SystemSettings, auth: str = Depends(get_current_user)):
     rules_db.settings = settings
     await database.save_config_json('system_settings', settings.model_dump())
+    notify_rules_changed()
     await notify_bot("⚠️ **系统设置已更新**\n请发送 /reload 以应用更改。")
     return {"status": "success"}
 
@@ -210,6 +219,7 @@ async def add_source(source: SourceConfig, auth: str = Depends(get_current_user)
     await database.save_source(source.model_dump())
     # 更新内存
     rules_db.sources.append(source)
+    notify_rules_changed()
     
     await notify_bot(f"➕ **新增监控源**: `{source.identifier}`")
     return {"status": "success"}
@@ -219,12 +229,14 @@ async def remove_source(data: Dict[str, Any], auth: str = Depends(get_current_us
     identifier = str(data.get('identifier'))
     await database.remove_source(identifier)
     rules_db.sources = [s for s in rules_db.sources if str(s.identifier) != identifier]
+    notify_rules_changed()
     return {"status": "success"}
 
 @app.post("/api/rules/add")
 async def add_rule(rule: TargetDistributionRule, auth: str = Depends(get_current_user)):
     await database.save_rule(rule.model_dump())
     rules_db.distribution_rules.append(rule)
+    notify_rules_changed()
     await notify_bot(f"➕ **新增分发规则**: `{rule.name}`")
     return rule
 
@@ -248,6 +260,7 @@ async def update_single_rule(rule: TargetDistributionRule, name_to_replace: str
         await database.remove_rule(name_to_replace)
         
     await database.save_rule(rule.model_dump())
+    notify_rules_changed()
     return {"status": "success"}
 
 class ReorderRequest(BaseModel):
@@ -268,6 +281,7 @@ async def reorder_rules(data: ReorderRequest, auth: str = Depends(get_current_us
             new_list.append(r)
     
     rules_db.distribution_rules = new_list
+    notify_rules_changed()
     
     # DB 重排：SQLite 没有原生顺序，我们必须清空重写
     await database.clear_rules()
@@ -281,6 +295,7 @@ async def remove_rule(data: Dict[str, str], auth: str = Depends(get_current_user
     name = data.get('name')
     await database.remove_rule(name)
     rules_db.distribution_rules = [r for r in rules_db.distribution_rules if r.name != name]
+    notify_rules_changed()
     return {"status": "success"}
 
 # --- Filters ---
@@ -293,6 +308,7 @@ async def get_blacklist(auth: str = Depends(get_current_user)):
 async def update_blacklist(config: AdFilterConfig, auth: str = Depends(get_current_user)):
     rules_db.ad_filter = config
     await database.save_config_json('ad_filter', config.model_dump())
+    notify_rules_changed()
     return {"status": "success"}
 
 @app.get("/api/whitelist", response_model=WhitelistConfig)
@@ -303,6 +319,7 @@ async def get_whitelist(auth: str = Depends(get_current_user)):
 async def update_whitelist(config: WhitelistConfig, auth: str = Depends(get_current_user)):
     rules_db.whitelist = config
     await database.save_config_json('whitelist', config.model_dump())
+    notify_rules_changed()
     return {"status": "success"}
 
 @app.get("/api/content_filter", response_model=ContentFilterConfig)
@@ -313,6 +330,7 @@ async def get_content_filter(auth: str = Depends(get_current_user)):
 async def update_content_filter(config: ContentFilterConfig, auth: str = Depends(get_current_user)):
     rules_db.content_filter = config
     await database.save_config_json('content_filter', config.model_dump())
+    notify_rules_changed()
     return {"status": "success"}
 
 @app.get("/api/replacements", response_model=Dict[str, str])
@@ -323,6 +341,7 @@ async def get_replacements(auth: str = Depends(get_current_user)):
 async def update_replacements(data: Dict[str, str], auth: str = Depends(get_current_user)):
     rules_db.replacements = data
     await database.save_config_json('replacements', data)
+    notify_rules_changed()
     return {"status": "success"}
 
 @app.get("/", response_class=HTMLResponse)